@@ -0,0 +1,62 @@
+"""Import-time profile (a summary of `python -X importtime`)
+
+    python -m benchmarks.importtime
+    python -m benchmarks.importtime --code "import main; main.app"
+"""
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+import click
+
+
+def profile(code: str) -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    """Run code with -X importtime in a fresh interpreter
+
+    Returns
+    -------
+    wall time (sec), and list of (package, depth, self [us], cumulative [us])
+    """
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        # "import time: {self} | {cumulative} | {indent}{package}"
+        head, cumulative, package = line.split("|", 2)
+        own = int(head.split(":", 1)[1])
+        name = package[1:].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), depth, own, int(cumulative)))
+    return wall, imports
+
+
+@click.command()
+@click.option("--code", "codes", multiple=True, default=["import main", "import main; main.app"])
+@click.option("--top", default=15)
+def main(codes: List[str], top: int):
+    for code in codes:
+        wall, imports = profile(code)
+        total = sum(own for _, _, own, _ in imports)
+        print(f"# {code}")
+        print(f"wall {wall * 1000:.0f} ms (interpreter included), imports {total / 1000:.0f} ms")
+        print("## top-level imports by cumulative time")
+        roots = sorted((i for i in imports if i[1] == 0), key=lambda i: i[3], reverse=True)
+        for name, _, _, cumulative in roots[:top]:
+            print(f"{cumulative / 1000:8.1f} ms  {name}")
+        print("## modules by self time")
+        for name, _, own, _ in sorted(imports, key=lambda i: i[2], reverse=True)[:top]:
+            print(f"{own / 1000:8.1f} ms  {name}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
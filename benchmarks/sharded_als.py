@@ -0,0 +1,52 @@
+"""ShardedALS by the number of workers, against implicit
+
+    OPENBLAS_NUM_THREADS=1 python -m benchmarks.sharded_als --workers 1,2,4
+
+"vs implicit" is implicit's time over ShardedALS's (> 1 means faster).
+implicit uses all cores, so compare at the worker count of the machine.
+"""
+import time
+
+import click
+import implicit
+import numpy
+from scipy.sparse import coo_matrix
+
+from island.als import ShardedALS
+
+
+def synthetic(users: int, items: int, nnz: int, seed: int = 42):
+    """(users, items) confidence matrix with popular items"""
+    random = numpy.random.default_rng(seed)
+    rows = random.integers(0, users, nnz)
+    cols = (random.pareto(1.2, nnz) * items / 20).astype(numpy.int64) % items
+    vals = random.choice(numpy.array([-1.0, 0.5, 1.0, 4.0], dtype=numpy.float32), nnz)
+    return coo_matrix((vals, (rows, cols)), shape=(users, items)).tocsr()
+
+
+@click.command()
+@click.option("--users", default=20000)
+@click.option("--items", default=5000)
+@click.option("--nnz", default=400000)
+@click.option("--factors", default=200)
+@click.option("--iterations", default=3)
+@click.option("--workers", default="1,2,4")
+def main(users: int, items: int, nnz: int, factors: int, iterations: int, workers: str):
+    user_items = synthetic(users, items, nnz)
+    print(f"matrix {users} x {items}, nnz={user_items.nnz}, factors={factors}")
+
+    start = time.perf_counter()
+    implicit.als.AlternatingLeastSquares(factors=factors, iterations=iterations).fit(
+        user_items, show_progress=False
+    )
+    base = time.perf_counter() - start
+    print(f"implicit          {base:8.2f} sec")
+
+    for num in [int(w) for w in workers.split(",")]:
+        start = time.perf_counter()
+        ShardedALS(factors=factors, iterations=iterations, workers=num).fit(user_items)
+        elapsed = time.perf_counter() - start
+        print(f"sharded workers={num:<2} {elapsed:8.2f} sec  vs implicit x{base / elapsed:.2f}")
+
+if __name__ == "__main__":
+    main()
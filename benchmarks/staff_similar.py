@@ -0,0 +1,131 @@
+"""Per-query cost of the staff walk, before/after edge weighting and capping
+
+    python -m benchmarks.staff_similar              # dataset/staffs.db
+    python -m benchmarks.staff_similar --synthetic 20000
+
+"before" is PageRank as it was before weighting (kept here as
+UnweightedPageRank): every staff name with >= 3 works, unpruned rows, and
+argpartition over the whole row at each step of an unmemoized walk.
+"""
+import random
+import statistics
+import time
+from collections import defaultdict
+from typing import List, Tuple
+
+import click
+import numpy
+from scipy.sparse import csr_matrix, diags
+
+from island.staff.graph import StaffGraph
+from island.staff.model import StaffModel
+from island.staff.pagerank import PageRank
+
+
+class UnweightedPageRank:
+    """PageRank before edge weighting and capping (for comparison)"""
+
+    def __init__(self, incidence: csr_matrix, works: List[int], num_staff_freq: int = 3):
+        staff_freq = numpy.asarray(incidence.sum(axis=0)).ravel()
+        keep = diags((staff_freq >= num_staff_freq).astype(numpy.float32))
+        incidence = (incidence @ keep).tocsr()
+        graph = (incidence @ incidence.T).tocsr()
+        degree = numpy.asarray(graph.sum(axis=1)).ravel()
+        degree[degree == 0] = 1.0
+        graph = (diags(1.0 / degree) @ graph).tocsr()
+        graph.eliminate_zeros()
+        self.graph = graph
+        self.works = works
+        self.index = {work_id: i for i, work_id in enumerate(works)}
+
+    def neighbours(self, i: int, num: int) -> List[Tuple[int, float]]:
+        start, end = self.graph.indptr[i], self.graph.indptr[i + 1]
+        indices = self.graph.indices[start:end]
+        probs = self.graph.data[start:end]
+        if len(indices) > num:
+            top = numpy.argpartition(-probs, num)[:num]
+            indices = indices[top]
+            probs = probs[top]
+        neigh = [(int(j), float(p)) for j, p in zip(indices, probs)]
+        neigh.sort(key=lambda item: item[1], reverse=True)
+        return neigh
+
+    def ranks(self, cur: int, num: int, depth: int) -> List[Tuple[int, float]]:
+        i = self.index.get(cur)
+        if i is None:
+            return [(cur, 1.0)]
+        return [(self.works[j], p) for j, p in self._ranks(i, num, depth)]
+
+    def _ranks(self, i: int, num: int, depth: int) -> List[Tuple[int, float]]:
+        if depth <= 0 or self.graph.indptr[i] == self.graph.indptr[i + 1]:
+            return [(i, 1.0)]
+        reached = defaultdict(float)
+        for u, p in self.neighbours(i, num):
+            reached[u] += p
+            for v, q in self._ranks(u, num, depth - 1):
+                reached[v] += p * q
+        reached = list(reached.items())
+        reached.sort(key=lambda item: item[1], reverse=True)
+        return reached[:num]
+
+
+MODELS = {
+    "before (unweighted, no cap, no memo)": UnweightedPageRank,
+    "after (bm25, capped, memoized)": PageRank,
+}
+
+
+def synthetic(num_rows: int, num_works: int = 4000, num_names: int = 3000, seed: int = 1) -> StaffGraph:
+    """Staff graph of random rows; names are Zipf-distributed (a few studios are hubs)"""
+    rand = random.Random(seed)
+    names = [f"name{i}" for i in range(num_names)]
+    weights = [1 / (i + 1) ** 1.1 for i in range(num_names)]
+    rows = [
+        (k + 1, "、".join(rand.choices(names, weights, k=3)), rand.randrange(num_works))
+        for k in range(num_rows)
+    ]
+    graph = StaffGraph()
+    graph.add(rows)
+    return graph
+
+
+def bench(model, works, num: int):
+    """Returns per-query times (sec) and the mean size of visited rows"""
+    times = []
+    for work_id in works:
+        start = time.perf_counter()
+        model.ranks(work_id, num + 3, depth=3)
+        times.append(time.perf_counter() - start)
+    i = [model.index[w] for w in works]
+    rowsize = statistics.mean(int(model.graph.indptr[k + 1] - model.graph.indptr[k]) for k in i)
+    return times, rowsize
+
+
+@click.command()
+@click.option("--queries", default=300)
+@click.option("--num", default=10)
+@click.option("--synthetic", "num_rows", default=0, help="Use this many random rows, not StaffDB")
+def main(queries: int, num: int, num_rows: int):
+    graph = synthetic(num_rows) if num_rows > 0 else StaffModel().graph
+    incidence = graph.incidence()
+    print(f"{len(graph.works)} works, {len(graph.names)} names, {incidence.nnz} edges")
+    random.seed(42)
+    works = random.sample(graph.works, min(queries, len(graph.works)))
+    for label, cls in MODELS.items():
+        start = time.perf_counter()
+        model = cls(incidence, graph.works)
+        build = time.perf_counter() - start
+        times, rowsize = bench(model, works, num)
+        times.sort()
+        print(f"# {label}")
+        print(f"build      {build:.2f} sec")
+        print(f"graph nnz  {model.graph.nnz}")
+        print(f"row size   {rowsize:.1f} (mean)")
+        print(f"query mean {statistics.mean(times) * 1000:.3f} ms")
+        print(f"query p50  {times[len(times) // 2] * 1000:.3f} ms")
+        print(f"query p99  {times[int(len(times) * 0.99)] * 1000:.3f} ms")
+        print(f"query max  {times[-1] * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,24 +3,19 @@ import logging
 import os
 
 import click
-import requests
-import urllib3
 from retry import retry
-from rich.logging import RichHandler
 
 from island import database
 
-urllib3.disable_warnings()
 FORMAT = "%(message)s"
-logging.basicConfig(
-    level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
-)
 logger = logging.getLogger("fetch.py")
-TOKEN = os.environ.get("ANNICT_TOKEN") or os.environ.get("TOKEN") or exit(1)
+TOKEN = None  # set by main()
 
 
 @retry(tries=10, delay=2)
 def get(uri: str, params: dict) -> dict:
+    import requests
+
     if uri.startswith("/"):
         uri = uri[1:]
     url = f"https://api.annict.com/{uri}"
@@ -31,6 +26,18 @@ def get(uri: str, params: dict) -> dict:
 
 @click.group()
 def main():
+    global TOKEN
+    import urllib3
+    from rich.logging import RichHandler
+
+    urllib3.disable_warnings()
+    logging.basicConfig(
+        level="NOTSET", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()]
+    )
+    TOKEN = os.environ.get("ANNICT_TOKEN") or os.environ.get("TOKEN")
+    if not TOKEN:
+        logger.error("Set ANNICT_TOKEN (or TOKEN)")
+        exit(1)
     logger.info("ANNICT TOKEN is %s", TOKEN)
 
 
@@ -59,8 +66,8 @@ def fetch_and_insert(
         for item in items:
             logger.info("Inserting %s", item)
             try:
-                db.insert(item)
-                num_changed += 1
+                if db.insert(item):
+                    num_changed += 1
             except Exception as err:
                 logger.warning("... Inserting Failed: %s", err)
 
@@ -101,7 +108,7 @@ def reviews(from_page: int, force: bool):
         "/v1/reviews",
         {
             "per_page": 50,
-            "fields": "id,work.id,user.id,rating_overall_state",
+            "fields": "id,work.id,user.id,rating_overall_state,created_at",
             "sort_id": "desc",
         },
         from_page,
@@ -120,7 +127,7 @@ def records(from_page: int, force: bool):
         "/v1/records",
         {
             "per_page": 50,
-            "fields": "id,work.id,user.id,rating_state",
+            "fields": "id,work.id,user.id,rating_state,created_at",
             "filter_has_record_comment": "true",
             "sort_id": "desc",
         },
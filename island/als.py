@@ -0,0 +1,234 @@
+import logging
+import multiprocessing
+import time
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger("uvicorn.main")
+
+# State of a worker process: name -> (confidence matrix, output factors, other factors)
+_worker: Dict[str, Tuple[csr_matrix, numpy.ndarray, numpy.ndarray]] = {}
+_shms: List[SharedMemory] = []
+
+# (name of shared memory, shape, dtype) of an array
+Shared = Tuple[str, Tuple[int, ...], str]
+
+
+def _share(array: numpy.ndarray, shms: List[SharedMemory]) -> Tuple[numpy.ndarray, Shared]:
+    """Copy an array into a new shared memory block (appended to shms)"""
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shms.append(shm)
+    shared = numpy.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shared, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach(desc: Shared) -> numpy.ndarray:
+    name, shape, dtype = desc
+    shm = SharedMemory(name=name)
+    _shms.append(shm)
+    return numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _attach_csr(descs: Tuple[Shared, Shared, Shared], shape: Tuple[int, int]) -> csr_matrix:
+    """CSR matrix over shared (data, indices, indptr), without copying"""
+    data, indices, indptr = (_attach(desc) for desc in descs)
+    mat = csr_matrix(shape, dtype=data.dtype)
+    mat.data, mat.indices, mat.indptr = data, indices, indptr
+    return mat
+
+
+def _init_worker(
+    user_items: Tuple[Shared, Shared, Shared],
+    item_users: Tuple[Shared, Shared, Shared],
+    user_factors: Shared,
+    item_factors: Shared,
+):
+    """Attach the shared matrices and factors in a worker"""
+    X = _attach(user_factors)
+    Y = _attach(item_factors)
+    _worker["users"] = (_attach_csr(user_items, (len(X), len(Y))), X, Y)
+    _worker["items"] = (_attach_csr(item_users, (len(Y), len(X))), Y, X)
+
+
+def least_squares_cg(
+    Cui: csr_matrix,
+    X: numpy.ndarray,
+    Y: numpy.ndarray,
+    YtY: numpy.ndarray,
+    start: int,
+    end: int,
+    cg_steps: int = 3,
+):
+    """Update X[start:end] from Y, as implicit's least_squares_cg
+
+    For each row u, with confidences c_ui = |Cui[u, i]| and preferences
+    p_ui = [Cui[u, i] > 0], X[u] approximately solves
+    (YtY + reg I + sum_i (c_ui - 1) y_i y_i^T) x = sum_i c_ui p_ui y_i
+    by cg_steps of conjugate gradient from its current value, where YtY is
+    given with the regularization already added.
+    All rows of the range are solved at once (a batch of CG).
+    """
+    lo, hi = Cui.indptr[start], Cui.indptr[end]
+    indptr = Cui.indptr[start : end + 1] - lo
+    indices = Cui.indices[lo:hi]
+    conf = Cui.data[lo:hi]
+    c = numpy.abs(conf)
+    shape = (end - start, Y.shape[0])
+    rows = numpy.repeat(numpy.arange(end - start), numpy.diff(indptr))
+    Yi = Y[indices]  # y_i of each nonzero
+
+    def matvec(P: numpy.ndarray) -> numpy.ndarray:
+        """A_u p_u for each row"""
+        d = numpy.einsum("nf,nf->n", Yi, P[rows]) * (c - 1.0)
+        return P @ YtY + csr_matrix((d, indices, indptr), shape=shape) @ Y
+
+    b = csr_matrix((numpy.where(conf > 0, c, 0.0), indices, indptr), shape=shape) @ Y
+    x = X[start:end].copy()
+    r = b - matvec(x)
+    p = r.copy()
+    rsold = numpy.einsum("uf,uf->u", r, r)
+    for _ in range(cg_steps):
+        active = rsold >= 1e-20
+        if not active.any():
+            break
+        Ap = matvec(p)
+        pAp = numpy.einsum("uf,uf->u", p, Ap)
+        alpha = numpy.where(active, rsold / numpy.where(active, pAp, 1.0), 0.0)
+        x += alpha[:, None] * p
+        r -= alpha[:, None] * Ap
+        rsnew = numpy.einsum("uf,uf->u", r, r)
+        beta = numpy.where(active, rsnew / numpy.where(active, rsold, 1.0), 0.0)
+        p = r + beta[:, None] * p
+        rsold = numpy.where(active, rsnew, 0.0)
+    x[numpy.diff(indptr) == 0] = 0.0  # no items: zero, as implicit
+    X[start:end] = x
+
+
+def _solve_shard(args: Tuple[str, int, int, numpy.ndarray]):
+    """Task of a worker: solve one shard of users (or items)"""
+    side, start, end, gram = args
+    Cui, X, Y = _worker[side]
+    least_squares_cg(Cui, X, Y, gram, start, end)
+
+
+def shards(num: int, size: int) -> List[Tuple[int, int]]:
+    """[0, num) into ranges of the size"""
+    return [(start, min(start + size, num)) for start in range(0, num, size)]
+
+
+class ShardedALS:
+    """Implicit ALS fitted by multiple local processes
+
+    Users are partitioned into shards and each worker solves the user
+    factors of its shard (batched conjugate gradient, as implicit); then
+    items are partitioned likewise. The confidence matrix (in both
+    orientations) and both factor matrices live in shared memory: workers
+    hold no copies, read the rows of their shard, write their factors in
+    place, and read the other side as updated in the previous half step.
+
+    The result has item_factors, user_factors and regularization as
+    implicit's AlternatingLeastSquares.
+
+    Workers are spawned, so the main script must be import-safe
+    (``if __name__ == "__main__"``).
+    """
+
+    def __init__(
+        self,
+        factors: int,
+        iterations: int = 10,
+        regularization: float = 0.01,
+        workers: int = 2,
+        shard_size: int = 1000,
+        random_state: Optional[int] = None,
+    ):
+        """Init
+
+        Parameters
+        ----------
+        factors
+            num of factors
+        iterations
+            num of ALS iterations
+        regularization
+            L2 regularization
+        workers
+            num of processes
+        shard_size
+            num of users (or items) per task
+        random_state
+            seed of initial factors
+        """
+        self.factors = factors
+        self.iterations = iterations
+        self.regularization = regularization
+        self.workers = workers
+        self.shard_size = shard_size
+        self.random_state = random_state
+        self.user_factors: Optional[numpy.ndarray] = None
+        self.item_factors: Optional[numpy.ndarray] = None
+
+    def fit(self, user_items: csr_matrix, show_progress: bool = False):
+        """Fitting
+
+        Parameters
+        ----------
+        user_items
+            (users, items) confidence matrix
+        """
+        user_items = csr_matrix(user_items, dtype=numpy.float32)
+        num_users, num_items = user_items.shape
+        eye = self.regularization * numpy.eye(self.factors, dtype=numpy.float32)
+
+        # Both matrices (and factors) are put in shared memory once; workers
+        # attach them instead of receiving pickled copies
+        shms: List[SharedMemory] = []
+        X = Y = None
+        try:
+            user_csr = tuple(
+                _share(a, shms)[1] for a in (user_items.data, user_items.indices, user_items.indptr)
+            )
+            item_users = user_items.T.tocsr()
+            item_csr = tuple(
+                _share(a, shms)[1] for a in (item_users.data, item_users.indices, item_users.indptr)
+            )
+            del item_users  # only the shared copy is kept
+            random = numpy.random.default_rng(self.random_state)
+            X, user_desc = _share(
+                random.random((num_users, self.factors), dtype=numpy.float32) * 0.01, shms
+            )
+            Y, item_desc = _share(
+                random.random((num_items, self.factors), dtype=numpy.float32) * 0.01, shms
+            )
+
+            context = multiprocessing.get_context("spawn")
+            initargs = (user_csr, item_csr, user_desc, item_desc)
+            with context.Pool(self.workers, _init_worker, initargs) as pool:
+                for iteration in range(self.iterations):
+                    start = time.time()
+                    YtY = Y.T @ Y + eye
+                    tasks = [("users", s, e, YtY) for s, e in shards(num_users, self.shard_size)]
+                    pool.map(_solve_shard, tasks)
+                    XtX = X.T @ X + eye
+                    tasks = [("items", s, e, XtX) for s, e in shards(num_items, self.shard_size)]
+                    pool.map(_solve_shard, tasks)
+                    if show_progress:
+                        logger.info(
+                            "ALS iteration %s/%s (%.2f sec, %s workers)",
+                            iteration + 1,
+                            self.iterations,
+                            time.time() - start,
+                            self.workers,
+                        )
+            self.user_factors = X.copy()
+            self.item_factors = Y.copy()
+        finally:
+            X = Y = None  # release the buffers before closing
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        return self
@@ -0,0 +1,399 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, RedirectResponse
+
+from island import memory
+from island.database import PrecomputedDB
+from island.profiling import SamplingProfiler, SlowRequestMiddleware, phase
+from island.recommendation import (
+    CHILDREN,
+    MixRecommendation,
+    build_child,
+    env_flag,
+    load_works,
+    signature,
+)
+from island.staff.model import StaffModel
+from island.web import StaticPage, etag_matches, json_response, not_modified, version_etag
+
+logger = logging.getLogger("uvicorn.main")
+
+
+class Models:
+    """Models built in background, after the server has bound its port
+
+    The staff model is cheap, so it is built first and /anime/api/info serves
+    its relatives (with titles from WorkDB) while the ALS children are still
+    being fitted. Each model is built independently; one failing does not
+    stop the others.
+    """
+
+    def __init__(self):
+        self.recommender: Optional[MixRecommendation] = None
+        self.staff_model: Optional[StaffModel] = None
+        # work_id -> title / image url, shared by the children
+        self.titles: Dict[int, str] = {}
+        self.images: Dict[int, str] = {}
+        self.version = "0"
+        self.progress = {"staff": "pending"}
+        self.progress.update({name: "pending" for name in CHILDREN})
+        self.memory: Dict[str, Dict[str, int]] = {}  # name -> structure -> bytes
+        # Output of precompute.py, used only when built with the same signature
+        self.precomputed_file: Optional[PrecomputedDB] = None
+        self.precomputed_meta: Dict[str, Optional[str]] = {}
+        self.precomputed: Optional[PrecomputedDB] = None
+
+    def _build(self, name: str, factory: Callable):
+        """Build a model with recording its progress and memory usage
+
+        Returns None (and logs) when it fails.
+        """
+        self.progress[name] = "building"
+        try:
+            model = factory()
+        except Exception:
+            logger.exception("Failed to build %s", name)
+            self.progress[name] = "failed"
+            return None
+        self.memory[name] = model.memory_usage()
+        for structure, size in self.memory[name].items():
+            logger.info("Memory %s.%s = %s", name, structure, memory.human(size))
+        logger.info("Memory %s = %s", name, memory.human(sum(self.memory[name].values())))
+        self.progress[name] = "ready"
+        return model
+
+    def build(self):
+        """Build all models (blocking)"""
+        works: Dict[str, Optional[Dict[int, str]]] = dict(titles=None, images=None)
+        try:
+            self.titles, self.images = load_works()
+            works = dict(titles=self.titles, images=self.images)
+        except Exception:
+            logger.exception("Failed to load titles")  # each child loads them
+        self.staff_model = self._build(
+            "staff", lambda: StaffModel(compact=env_flag("ISLAND_COMPACT"))
+        )
+
+        try:
+            sig = signature()
+        except Exception:
+            logger.exception("Failed to take the signature of datasets")
+            sig = None
+        children = {
+            name: self._build(name, lambda: build_child(name, **works)) for name in CHILDREN
+        }
+        children = {name: child for name, child in children.items() if child is not None}
+        if len(children) == 0:
+            logger.error("No recommender is available")
+            return
+        recommender = MixRecommendation(children)
+        if env_flag("ISLAND_COMPACT"):
+            self.titles, self.images = recommender.prune_works()
+        self.memory["works"] = memory.report({"titles": self.titles, "images": self.images})
+        self.recommender = recommender
+        # Same datasets and options give the same (seeded) models, so the version
+        # and ETags agree across restarts and replicas
+        if sig is not None and len(children) == len(CHILDREN):
+            self.version = hashlib.sha1(sig.encode()).hexdigest()[:12]
+        else:
+            self.version = format(int(time.time()), "x")
+        if self.precomputed_file is not None:
+            if len(children) < len(CHILDREN) or sig != self.precomputed_meta.get("signature"):
+                logger.warning("Precomputed recommendations are not of these models; ignored")
+            else:
+                self.precomputed = self.precomputed_file
+                self.version += "-" + (self.precomputed_meta.get("version") or "0")
+        logger.info("Ready (version=%s)", self.version)
+
+    def start(self) -> threading.Thread:
+        """Build all models in a background thread"""
+        thread = threading.Thread(target=self.build, name="build-models", daemon=True)
+        thread.start()
+        return thread
+
+    def isready(self) -> bool:
+        """The recommender is available
+
+        The staff model (built before it) and the other children are
+        optional; failures of them are reported by isdegraded.
+        """
+        return self.recommender is not None
+
+    def isdegraded(self) -> bool:
+        """Some model failed to build"""
+        return "failed" in self.progress.values()
+
+    def title(self, work_id: int) -> Optional[str]:
+        """Anime title, from the recommender or WorkDB"""
+        if self.recommender is not None:
+            return self.recommender.title(work_id)
+        return self.titles.get(work_id)
+
+
+models = Models()
+
+# Output of precompute.py
+PRECOMPUTED_PATH = "dataset/precomputed.db"
+
+# Cache-Control for API responses; they are valid until the next model reload
+API_CACHE_CONTROL = "public, max-age=600"
+
+pages: Dict[str, StaticPage] = {}  # loaded by create_app
+
+router = APIRouter()
+
+
+def not_ready() -> HTTPException:
+    """503 while models are being built"""
+    return HTTPException(
+        status_code=503,
+        detail="Models are not ready",
+        headers={"Retry-After": "10"},
+    )
+
+
+def get_recommender() -> MixRecommendation:
+    """Dependency: the recommender, or 503"""
+    if models.recommender is None:
+        raise not_ready()
+    return models.recommender
+
+
+async def build_models():
+    """Start building models without blocking the port binding"""
+    if os.path.exists(PRECOMPUTED_PATH):
+        # opened in the event loop thread, where endpoints run
+        db = PrecomputedDB(PRECOMPUTED_PATH)
+        models.precomputed_meta = {key: db.get_meta(key) for key in ("signature", "version")}
+        models.precomputed_file = db
+        logger.info("Precomputed recommendations: %s like-sets", len(db))
+    models.start()
+
+
+@router.get("/healthz")
+async def healthz():
+    """Liveness"""
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+async def readyz(request: Request):
+    """Readiness with per-model build progress"""
+    content = {
+        "ready": models.isready(),
+        "degraded": models.isdegraded(),
+        "version": models.version,
+        "models": models.progress,
+    }
+    return json_response(request, content, status_code=200 if models.isready() else 503)
+
+
+@router.get("/memz")
+async def memz(request: Request):
+    """Memory usage of each structure of built models (bytes)"""
+    content = {
+        "models": models.memory,
+        "total": sum(size for usage in models.memory.values() for size in usage.values()),
+    }
+    return json_response(request, content)
+
+
+@router.get("/anime/api/info")
+async def anime_info(request: Request, work_id: int):
+    """Returns Info
+
+    While the recommender is being built, only relatives_staff is served
+    (uncached), and unknown works are those not in the staff graph.
+    """
+    recommender = models.recommender
+    staff_model = models.staff_model
+    if recommender is None and staff_model is None:
+        raise not_ready()
+    if recommender is not None:
+        known = recommender.isknown(work_id)
+    else:
+        known = staff_model.isknown(work_id)
+    if not known:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    etag = None
+    cache_control = "no-store"
+    if recommender is not None:
+        etag = version_etag(models.version, request)
+        cache_control = API_CACHE_CONTROL
+        if etag_matches(request, etag):
+            return not_modified(etag, cache_control)
+
+    relatives_watch = []
+    if recommender is not None:
+        relatives_watch = recommender.similar_items(work_id, 5)  # timed by child (als.*)
+    relatives_staff = []
+    if staff_model is not None:
+        with phase("staff"):
+            relatives_staff = [
+                (work_id, score)
+                for (work_id, score) in staff_model.similar_items(work_id, 10)
+                if recommender is None or recommender.isknown(work_id)
+            ][:5]
+
+    with phase("titles"):
+        content = {
+            "workId": work_id,
+            "title": models.title(work_id),
+            "image": recommender.image(work_id) if recommender is not None else None,
+            "relatives_watch": [
+                {
+                    "workId": work_id,
+                    "title": models.title(work_id),
+                    "score": float(score),
+                }
+                for work_id, score in relatives_watch
+            ],
+            "relatives_staff": [
+                {
+                    "workId": work_id,
+                    "title": models.title(work_id),
+                    "score": float(score),
+                }
+                for work_id, score in relatives_staff
+            ],
+        }
+    return json_response(request, content, etag=etag, cache_control=cache_control)
+
+
+@router.get("/anime/api/recommend")
+async def recommend(
+    request: Request,
+    likes: List[int] = Query(None),
+    recommender: MixRecommendation = Depends(get_recommender),
+):
+    """Recommendation from user's likes
+
+    Parameters
+    ----------
+    likes
+        List of workId
+    """
+    if likes is None:
+        works = recommender.sample_animes(20)
+        content = {
+            "items": [
+                {
+                    "workId": work_id,
+                    "title": recommender.title(work_id),
+                    "image": recommender.image(work_id),
+                }
+                for work_id in works
+            ]
+        }
+        return json_response(request, content)
+
+    etag = version_etag(models.version, request)
+    if etag_matches(request, etag):
+        return not_modified(etag, API_CACHE_CONTROL)
+
+    with phase("precomputed"):
+        recommend_items = models.precomputed and models.precomputed.get(likes)
+    if recommend_items is None:
+        recommend_items = recommender(likes, 20)  # timed by child (als.*)
+    with phase("titles"):
+        content = {
+            "items": [
+                {
+                    "workId": work_id,
+                    "title": recommender.title(work_id),
+                    "image": recommender.image(work_id),
+                    "score": float(score),
+                }
+                for work_id, score in recommend_items
+            ],
+            "source": {
+                "likes": [
+                    {"workId": work_id, "title": recommender.title(work_id)} for work_id in likes
+                ]
+            },
+        }
+    return json_response(request, content, etag=etag, cache_control=API_CACHE_CONTROL)
+
+
+@router.get("/anime/recommend", response_class=HTMLResponse)
+async def index_recommend(request: Request):
+    """Recommendation Page"""
+    return pages["recommend"].response(request)
+
+
+@router.get("/anime/random", response_class=RedirectResponse)
+async def index_random(recommender: MixRecommendation = Depends(get_recommender)):
+    """Redirect to Random /anime/{work_id}"""
+    work_id = recommender.sample_animes(1)[0]
+    return RedirectResponse(f"/anime/{work_id}")
+
+
+@router.get("/anime/{work_id}", response_class=HTMLResponse)
+async def index_anime_graph(
+    request: Request,
+    work_id: int,
+    recommender: MixRecommendation = Depends(get_recommender),
+):
+    """Index for Each Anime"""
+    if not recommender.isknown(work_id):
+        raise HTTPException(status_code=404, detail="Item not found")
+    return pages["anime"].response(request)
+
+
+@router.get("/", response_class=RedirectResponse)
+async def index():
+    """Redirect to /anime"""
+    return RedirectResponse("/anime")
+
+
+@router.get("/anime", response_class=HTMLResponse)
+async def index_anime(request: Request):
+    """Index of All"""
+    return pages["index"].response(request)
+
+
+def create_app() -> FastAPI:
+    """The web app; models are built in background after startup"""
+    logger.info("Launching a Web Server")
+    pages.update(
+        {
+            "index": StaticPage("./templates/index.html"),
+            "anime": StaticPage("./templates/anime.html"),
+            "recommend": StaticPage("./templates/recommend.html"),
+        }
+    )
+    app = FastAPI()
+
+    origins = [
+        "http://cympfh.cc",
+        "http://s.cympfh.cc",
+        "http://localhost",
+        "http://localhost:8080",
+    ]
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_event_handler("startup", build_models)
+    app.include_router(router)
+
+    # Slow-request log, and the sampling profiler (opt-in)
+    threshold = float(os.environ.get("ISLAND_SLOW_REQUEST_MS", "500")) / 1000
+    profiler = None
+    if os.environ.get("ISLAND_PROFILE_DIR"):
+        interval = float(os.environ.get("ISLAND_PROFILE_INTERVAL_MS", "5")) / 1000
+        profiler = SamplingProfiler(os.environ["ISLAND_PROFILE_DIR"], interval)
+    app.add_middleware(SlowRequestMiddleware, threshold=threshold, profiler=profiler)
+    return app
@@ -1,9 +1,26 @@
 import contextlib
+import datetime
+import json
 import sqlite3
-from typing import Iterator
+from typing import Iterator, List, Optional, Tuple
+
+
+def timestamp(value: Optional[str]) -> Optional[str]:
+    """API の ISO8601 (2016-05-03T19:06:44.000Z) を SQLite の形式 (UTC) にする"""
+    if not value:
+        return None
+    t = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if t.tzinfo is not None:
+        t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return t.strftime("%Y-%m-%d %H:%M:%S")
 
 
 class RDB:
+    # レコードの時刻 (iter_with_age で使う). dt は fetch.py が取ってきた時刻
+    time_column = "dt"
+    # insert で id が重複したときの処理
+    on_conflict = ""
+
     def __init__(self, database: str, table: str, schema: str):
         self.con = sqlite3.connect(database)
         self.table = table
@@ -16,6 +33,14 @@ class RDB:
         with self.execute(q, ()):
             pass
 
+    def add_column(self, name: str, definition: str):
+        """古いファイルに無いカラムを足す"""
+        with self.execute(f"PRAGMA table_info({self.table})", ()) as cur:
+            columns = [row[1] for row in cur.fetchall()]
+        if name not in columns:
+            with self.execute(f"ALTER TABLE {self.table} ADD COLUMN {name} {definition}", ()):
+                pass
+
     @contextlib.contextmanager
     def execute(self, query: str, params: tuple):
         cur = self.con.cursor()
@@ -44,7 +69,7 @@ class RDB:
         num = len(names)
         placeholder = ",".join(["?"] * num)
 
-        q = f"INSERT INTO {self.table}({fields}) VALUES ({placeholder})"
+        q = f"INSERT INTO {self.table}({fields}) VALUES ({placeholder}) {self.on_conflict}"
         with self.execute(q, tuple(values)) as cur:
             return cur.rowcount > 0
 
@@ -55,12 +80,39 @@ class RDB:
             (count,) = cur.fetchone()
             return count
 
+    def fingerprint(self) -> list:
+        """中身が変わったかの目安: 行数, 最大の id, 最新の dt, 時刻の総和"""
+        t = self.time_column
+        q = f"SELECT COUNT(*), MAX(id), MAX(dt), TOTAL(julianday({t})) FROM {self.table}"
+        with self.execute(q, ()) as cur:
+            return list(cur.fetchone())
+
     def __iter__(self) -> Iterator:
         """レコードの全列挙"""
         q = f"SELECT * FROM {self.table}"
         with self.execute(q, ()) as cur:
             return iter(cur.fetchall())
 
+    def iter_with_age(self, max_age: Optional[float] = None) -> Iterator:
+        """レコードの列挙 (最後の列に, 最新のレコードからの経過日数を付ける)
+
+        時刻は time_column で, 最新のレコードもそれで決める
+
+        Parameters
+        ----------
+        max_age
+            これより古い (日) レコードは読まない
+        """
+        t = self.time_column
+        latest = f"(SELECT MAX({t}) FROM {self.table})"
+        q = f"SELECT *, julianday({latest}) - julianday({t}) FROM {self.table}"
+        params: tuple = ()
+        if max_age is not None:
+            q += f" WHERE {t} >= datetime({latest}, ?)"
+            params = (f"-{max_age} days",)
+        with self.execute(q, params) as cur:
+            return iter(cur.fetchall())
+
 
 class WorkDB(RDB):
     """作品
@@ -95,11 +147,20 @@ class WorkDB(RDB):
 class ReviewDB(RDB):
     """作品への記録
 
+    created_at は API の作成日時 (dt は取ってきた時刻).
+    created_at の無い古い行は fetch.py で取り直すと埋まる.
+
     References
     ----------
     - https://developers.annict.com/docs/rest-api/v1/reviews
     """
 
+    time_column = "COALESCE(created_at, dt)"
+    on_conflict = (
+        "ON CONFLICT(id) DO UPDATE SET created_at = excluded.created_at"
+        " WHERE created_at IS NULL AND excluded.created_at IS NOT NULL"
+    )
+
     def __init__(self):
         schema = """
         (
@@ -107,32 +168,41 @@ class ReviewDB(RDB):
             user_id INTEGER NOT NULL,
             work_id INTEGER NOT NULL,
             rating_overall_state TEXT,
-            dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP
         )
         """
         super().__init__("dataset/reviews.db", "reviews", schema)
+        self.add_column("created_at", "TIMESTAMP")
 
     def to_dict(self, item) -> dict:
         id = item["id"]
         user_id = item["user"]["id"]
         work_id = item["work"]["id"]
         rating_overall_state = item["rating_overall_state"]
+        created_at = timestamp(item.get("created_at"))
         return {
             "id": id,
             "user_id": user_id,
             "work_id": work_id,
             "rating_overall_state": rating_overall_state,
+            "created_at": created_at,
         }
 
 
 class RecordDB(RDB):
     """エピソードへの記録
 
+    created_at は ReviewDB と同じ
+
     References
     ----------
     - https://developers.annict.com/docs/rest-api/v1/records
     """
 
+    time_column = ReviewDB.time_column
+    on_conflict = ReviewDB.on_conflict
+
     def __init__(self):
         schema = """
         (
@@ -140,21 +210,25 @@ class RecordDB(RDB):
             user_id INTEGER NOT NULL,
             work_id INTEGER NOT NULL,
             rating_state TEXT,
-            dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP
         )
         """
         super().__init__("dataset/records.db", "records", schema)
+        self.add_column("created_at", "TIMESTAMP")
 
     def to_dict(self, item) -> dict:
         id = item["id"]
         user_id = item["user"]["id"]
         work_id = item["work"]["id"]
         rating_state = item["rating_state"]
+        created_at = timestamp(item.get("created_at"))
         return {
             "id": id,
             "user_id": user_id,
             "work_id": work_id,
             "rating_state": rating_state,
+            "created_at": created_at,
         }
 
 
@@ -177,6 +251,12 @@ class StaffDB(RDB):
         """
         super().__init__("dataset/staffs.db", "staffs", schema)
 
+    def since(self, last_id: int) -> List[Tuple[int, str, int]]:
+        """id が last_id より大きいレコード (id, name, work_id) の一括読み込み"""
+        q = f"SELECT id, name, work_id FROM {self.table} WHERE id > ? ORDER BY id"
+        with self.execute(q, (last_id,)) as cur:
+            return cur.fetchall()
+
     def to_dict(self, item) -> dict:
         id = item["id"]
         name = item["name"]
@@ -186,3 +266,61 @@ class StaffDB(RDB):
             "name": name,
             "work_id": work_id,
         }
+
+
+class PrecomputedDB(RDB):
+    """事前計算した推薦 (likes の集合 -> 推薦結果)
+
+    meta テーブルに, どのデータとオプションで計算したか (signature) と version を持つ
+    """
+
+    def __init__(self, database: str = "dataset/precomputed.db"):
+        schema = """
+        (
+            likes TEXT PRIMARY KEY NOT NULL,
+            items TEXT NOT NULL,
+            dt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+        super().__init__(database, "precomputed", schema)
+        q = "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY NOT NULL, value TEXT NOT NULL)"
+        with self.execute(q, ()):
+            pass
+
+    def set_meta(self, key: str, value: str):
+        q = "INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)"
+        with self.execute(q, (key, value)):
+            pass
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self.execute("SELECT value FROM meta WHERE key = ?", (key,)) as cur:
+            row = cur.fetchone()
+        return None if row is None else row[0]
+
+    @staticmethod
+    def key(likes: List[int]) -> str:
+        """likes の集合のキー (順序と重複を無視する)"""
+        return ",".join(str(work_id) for work_id in sorted(set(likes)))
+
+    def to_dict(self, item: Tuple[List[int], List[Tuple[int, float]]]) -> dict:
+        likes, items = item
+        return {
+            "likes": self.key(likes),
+            "items": json.dumps([[work_id, score] for work_id, score in items]),
+        }
+
+    def insert_many(self, items: List[Tuple[List[int], List[Tuple[int, float]]]]):
+        """まとめて挿入 (上書き)"""
+        rows = [tuple(self.to_dict(item).values()) for item in items]
+        q = f"INSERT OR REPLACE INTO {self.table}(likes, items) VALUES (?, ?)"
+        self.con.executemany(q, rows)
+        self.con.commit()
+
+    def get(self, likes: List[int]) -> Optional[List[Tuple[int, float]]]:
+        """事前計算した推薦 (無ければ None)"""
+        q = f"SELECT items FROM {self.table} WHERE likes = ?"
+        with self.execute(q, (self.key(likes),)) as cur:
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return [(work_id, score) for work_id, score in json.loads(row[0])]
@@ -0,0 +1,81 @@
+import sys
+from typing import Dict, Iterable, Optional, Set
+
+import numpy
+
+
+def sizeof(obj, seen: Optional[Set[int]] = None) -> int:
+    """Approximate deep size of an object in bytes
+
+    Containers are followed recursively; numpy arrays and scipy sparse
+    matrices are counted by their buffers. Shared objects are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if obj is None or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, numpy.ndarray):
+        return sys.getsizeof(obj) if obj.base is None else obj.nbytes
+    if hasattr(obj, "indptr") and hasattr(obj, "indices") and hasattr(obj, "data"):
+        # scipy.sparse.csr_matrix or csc_matrix
+        return sum(sizeof(a, seen) for a in (obj.data, obj.indices, obj.indptr))
+    if isinstance(obj, IntIndex):
+        return sizeof(obj.keys, seen) + sizeof(obj.values, seen)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(item, seen) for item in obj)
+    return size
+
+
+def report(structures: Dict[str, object]) -> Dict[str, int]:
+    """Sizes of named structures (bytes)"""
+    seen: Set[int] = set()
+    return {name: sizeof(obj, seen) for name, obj in structures.items()}
+
+
+def human(size: float) -> str:
+    """Human readable bytes"""
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+class IntIndex:
+    """Mapping from int keys to int32 positions, backed by sorted arrays
+
+    A compact replacement of Dict[int, int] for read-only lookups.
+    """
+
+    def __init__(self, keys: Iterable[int]):
+        """keys[i] is mapped to i"""
+        keys = numpy.asarray(list(keys), dtype=numpy.int64)
+        order = numpy.argsort(keys, kind="stable")
+        self.keys = keys[order].astype(numpy.int32)
+        self.values = order.astype(numpy.int32)
+
+    def _find(self, key: int) -> int:
+        pos = int(numpy.searchsorted(self.keys, key))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return pos
+        return -1
+
+    def __contains__(self, key: int) -> bool:
+        return self._find(key) >= 0
+
+    def __getitem__(self, key: int) -> int:
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(key)
+        return int(self.values[pos])
+
+    def get(self, key: int, default=None):
+        pos = self._find(key)
+        return default if pos < 0 else int(self.values[pos])
+
+    def __len__(self) -> int:
+        return len(self.keys)
@@ -0,0 +1,163 @@
+import collections
+import contextlib
+import contextvars
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Counter, Dict, Optional, Tuple
+
+logger = logging.getLogger("uvicorn.main")
+
+# Phase -> seconds, of the request being served (None when not measured)
+_phases: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "phases", default=None
+)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """Measure a phase of the current request
+
+    A no-op outside SlowRequestMiddleware.
+    """
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+
+def fold(frame) -> str:
+    """A stack in the folded format of flamegraph.pl (root first, ';'-separated)"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    """Samples stacks of threads serving requests, in one background thread
+
+    Requests served concurrently on the same thread (the event loop) share
+    the samples taken while they overlap.
+    """
+
+    def __init__(self, directory: str, interval: float = 0.005):
+        """Init
+
+        Parameters
+        ----------
+        directory
+            where to write stacks (*.folded)
+        interval
+            sampling interval (sec)
+        """
+        self.directory = directory
+        self.interval = interval
+        self.active: Dict[int, Tuple[int, Counter[str]]] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.written = itertools.count()  # makes file names unique within the process
+        os.makedirs(directory, exist_ok=True)
+
+    def begin(self) -> Counter[str]:
+        """Start sampling the current thread for a request"""
+        stacks: Counter[str] = collections.Counter()
+        with self.lock:
+            self.active[id(stacks)] = (threading.get_ident(), stacks)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+        return stacks
+
+    def end(self, stacks: Counter[str]):
+        """Stop sampling for the request"""
+        with self.lock:
+            self.active.pop(id(stacks), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self.active.values():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[fold(frame)] += 1
+
+    def write(self, name: str, stacks: Counter[str]) -> str:
+        """Write stacks in the folded format (for flamegraph.pl, speedscope etc.)"""
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(
+            self.directory, f"{stamp}-{name}-{os.getpid()}-{next(self.written)}.folded"
+        )
+        with open(path, "xt") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+class SlowRequestMiddleware:
+    """ASGI middleware logging requests slower than the threshold
+
+    The log has the path, parameters, wall time and the breakdown by phase().
+    With a SamplingProfiler, stacks of slow requests are written too.
+    """
+
+    def __init__(self, app, threshold: float, profiler: Optional[SamplingProfiler] = None):
+        """Init
+
+        Parameters
+        ----------
+        app
+            ASGI app
+        threshold
+            requests slower than this (sec) are logged
+        profiler
+            opt-in profiler
+        """
+        self.app = app
+        self.threshold = threshold
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        phases: Dict[str, float] = {}
+        token = _phases.set(phases)
+        stacks = self.profiler.begin() if self.profiler is not None else None
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            wall = time.perf_counter() - start
+            _phases.reset(token)
+            if stacks is not None:
+                self.profiler.end(stacks)
+            if wall >= self.threshold:
+                self.report(scope, wall, phases, stacks)
+
+    def report(self, scope, wall: float, phases: Dict[str, float], stacks: Optional[Counter[str]]):
+        """Log a slow request"""
+        breakdown = " ".join(f"{name}={sec * 1000:.1f}ms" for name, sec in phases.items())
+        target = scope["path"]
+        if scope.get("query_string"):
+            target += "?" + scope["query_string"].decode(errors="replace")
+        logger.warning("Slow request %.1fms %s %s %s", wall * 1000, scope["method"], target, breakdown)
+        if stacks:
+            name = scope["path"].strip("/").replace("/", "_") or "index"
+            path = self.profiler.write(name, stacks)
+            logger.warning("... stacks written to %s", path)
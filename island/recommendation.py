@@ -0,0 +1,574 @@
+import collections
+import json
+import logging
+import os
+import random
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+
+from island import memory
+from island.database import RDB, RecordDB, ReviewDB, WorkDB
+from island.memory import IntIndex
+from island.profiling import phase
+
+logger = logging.getLogger("uvicorn.main")
+
+# Interactions older than this many half-lives are pruned (weight < 1/32)
+DECAY_HORIZON = 5
+
+# Seed of ALS, so that the same data and options give the same model
+# (precompute.py and the server must agree)
+ALS_SEED = 42
+
+
+class ItemFactors:
+    """Item factors of a fitted ALS, for serving
+
+    Users are always recalculated from their likes, so user factors are not
+    needed here. The maths is the same as implicit's recalculate_user and
+    similar_items, done with numpy so the factors may be float16.
+    """
+
+    def __init__(self, item_factors: numpy.ndarray, regularization: float, dtype: str = "float32"):
+        """Init
+
+        Parameters
+        ----------
+        item_factors
+            (num of items, num of factors)
+        regularization
+            regularization of the ALS
+        dtype
+            dtype of factors to keep, "float32" or "float16"
+        """
+        Y = numpy.asarray(item_factors, dtype=numpy.float32)
+        self.YtY = Y.T @ Y + regularization * numpy.eye(Y.shape[1], dtype=numpy.float32)
+        self.norms = numpy.linalg.norm(Y, axis=1)
+        self.norms[self.norms == 0] = 1e-10
+        self.item_factors = Y.astype(dtype, copy=False)
+
+    def user_factor(self, items: numpy.ndarray, confidence: float) -> numpy.ndarray:
+        """Factor of a user who likes the items"""
+        Y = self.item_factors[items].astype(numpy.float32)
+        A = self.YtY + (confidence - 1.0) * (Y.T @ Y)
+        b = confidence * Y.sum(axis=0)
+        return numpy.linalg.solve(A, b).astype(self.item_factors.dtype)
+
+    @staticmethod
+    def top(scores: numpy.ndarray, n: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Top-n (indices, scores)"""
+        n = min(n, len(scores))
+        indices = numpy.argpartition(-scores, n - 1)[:n]
+        indices = indices[numpy.argsort(-scores[indices], kind="stable")]
+        return indices, scores[indices]
+
+    def recommend(
+        self, items: numpy.ndarray, n: int, confidence: float = 2.0
+    ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Items for a user who likes the items (excluding them)"""
+        scores = (self.item_factors @ self.user_factor(items, confidence)).astype(numpy.float32)
+        scores[items] = -numpy.inf
+        return self.top(scores, n)
+
+    def similar_items(self, i: int, n: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Items similar to the i-th (cosine)"""
+        scores = (self.item_factors @ self.item_factors[i]).astype(numpy.float32)
+        scores /= self.norms * self.norms[i]
+        return self.top(scores, n)
+
+
+class Matrix:
+    """Matrix-decompositionable"""
+
+    def __init__(self):
+        """Initialize as Empty"""
+        self.rows = []
+        self.cols = []
+        self.row_id = dict()
+        self.col_id = dict()
+        self.data = dict()
+        self.fact = None
+        self.factors: Optional[ItemFactors] = None
+
+    def insert(self, row: int, col: int, val: float):
+        """Insert a value
+
+        Parameters
+        ----------
+        row
+            workId
+        col
+            userId
+        val
+            reviewed?
+        """
+        if row not in self.row_id:
+            self.rows.append(row)
+            self.row_id[row] = len(self.row_id)
+            assert self.rows[self.row_id[row]] == row
+        if col not in self.col_id:
+            self.cols.append(col)
+            self.col_id[col] = len(self.col_id)
+            assert self.cols[self.col_id[col]] == col
+        i = self.row_id[row]
+        j = self.col_id[col]
+        self.data[(i, j)] = val
+
+    def decomposition(self, factors: int, workers: int = 0):
+        """Fitting
+
+        Parameters
+        ----------
+        factors
+            num of factors
+        workers
+            If > 1, fit with ShardedALS in this many processes
+            (otherwise with implicit)
+        """
+        from scipy.sparse import coo_matrix
+
+        X = coo_matrix(
+            (
+                numpy.fromiter(self.data.values(), dtype=numpy.float32, count=len(self.data)),
+                (
+                    numpy.fromiter((i for i, _ in self.data), dtype=numpy.int32, count=len(self.data)),
+                    numpy.fromiter((j for _, j in self.data), dtype=numpy.int32, count=len(self.data)),
+                ),
+            ),
+            shape=(len(self.rows), len(self.cols)),
+        )
+        if workers > 1:
+            from island.als import ShardedALS
+
+            fact = ShardedALS(
+                factors=factors, iterations=10, workers=workers, random_state=ALS_SEED
+            )
+        else:
+            import implicit
+
+            fact = implicit.als.AlternatingLeastSquares(
+                factors=factors, iterations=10, random_state=ALS_SEED
+            )
+        fact.fit(user_items=X.transpose().tocsr(), show_progress=True)
+        self.fact = fact
+        self.factors = ItemFactors(fact.item_factors, fact.regularization)
+
+    def compact(self, dtype: str = "float32"):
+        """Shrink for serving
+
+        - keep item factors in dtype (float32 or float16)
+        - drop the ALS model (with its user factors) and the training data
+        - replace rows and row_id with int32 arrays
+        """
+        self.factors = ItemFactors(self.fact.item_factors, self.fact.regularization, dtype=dtype)
+        self.fact = None
+        self.data = dict()
+        self.cols = []
+        self.col_id = dict()
+        self.row_id = IntIndex(self.rows)
+        self.rows = numpy.asarray(self.rows, dtype=numpy.int32)
+
+    def stat(self):
+        """Debug"""
+        logger.info(
+            f"Size: {len(self.rows)} x {len(self.cols)} = {len(self.rows) * len(self.cols)}"
+        )
+        logger.info(
+            f"{len(self.data)} cells have non-zero values (density={len(self.data) / len(self.rows) / len(self.cols)})"
+        )
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes of each structure"""
+        structures = {
+            "rows": self.rows,
+            "row_id": self.row_id,
+            "cols": self.cols,
+            "col_id": self.col_id,
+            "data": self.data,
+            "factors.item_factors": self.factors.item_factors,
+            "factors.YtY": self.factors.YtY,
+            "factors.norms": self.factors.norms,
+        }
+        if self.fact is not None:
+            structures["als.user_factors"] = self.fact.user_factors
+            # the same array as factors.item_factors unless converted
+            if self.fact.item_factors is not self.factors.item_factors:
+                structures["als.item_factors"] = self.fact.item_factors
+        return memory.report(structures)
+
+    def recommend(self, likes: List[int], n: int) -> List[Tuple[int, float]]:
+        """Run Recommendation
+
+        Parameters
+        ----------
+        likes
+            List of work_id
+        n
+            num of returns
+
+        Returns
+        -------
+        List of (work_id and score)
+        """
+        items = numpy.array(
+            sorted({self.row_id[work_id] for work_id in likes if work_id in self.row_id}),
+            dtype=numpy.int32,
+        )
+        recommend_items, recommend_scores = self.factors.recommend(items, n)
+        return [
+            (int(self.rows[int(i)]), float(score))
+            for i, score in zip(recommend_items, recommend_scores)
+        ]
+
+    def similar_items(self, work_id: int, n: int) -> List[Tuple[int, float]]:
+        """Similar animes (including itself)"""
+        i = self.row_id[work_id]
+        similars, scores = self.factors.similar_items(i, n)
+        return [(int(self.rows[int(j)]), float(score)) for j, score in zip(similars, scores)]
+
+
+def load_works() -> Tuple[Dict[int, str], Dict[int, str]]:
+    """Titles and image urls (work_id -> str) of all works, to be shared by children"""
+    titles = dict()  # work_id -> title
+    images = dict()  # work_id -> ImageUrl
+    for work_id, title, image, _dt in WorkDB():
+        titles[work_id] = title
+        images[work_id] = image
+    return titles, images
+
+
+class Recommendation:
+    """Recommendation has a Matrix"""
+
+    def __init__(
+        self,
+        dataset: RDB,
+        limit_anime: int,
+        limit_user: int,
+        window_days: Optional[float] = None,
+        half_life_days: Optional[float] = None,
+        compact: bool = False,
+        dtype: str = "float32",
+        als_workers: int = 0,
+        titles: Optional[Dict[int, str]] = None,
+        images: Optional[Dict[int, str]] = None,
+    ):
+        """init
+
+        Parameters
+        ----------
+        dataset
+            RDB of Record(work_id, user_id, rating)
+            This is reviews or records.
+        limit_anime
+            sub limit of freq of anime
+        limit_user
+            sub limit of freq of user
+        window_days
+            Use only interactions within this many days from the latest one.
+            Ages are by created_at (from the API), or by dt (fetch time)
+            for rows fetched without it.
+        half_life_days
+            Decay weights of interactions exponentially with this half-life.
+            Without window_days, interactions older than DECAY_HORIZON
+            half-lives are pruned.
+        compact
+            Shrink the model after fitting (see Matrix.compact)
+        dtype
+            dtype of factors in compact mode
+        als_workers
+            num of processes for ShardedALS (0 for implicit)
+        titles, images
+            from load_works(), shared with other children (loaded if None)
+        """
+        logger.info("Initializing a Recommender for %s", dataset.table)
+
+        if titles is None or images is None:
+            titles, images = load_works()
+
+        rows = []  # List of (work_id, user_id, rating)
+        count_anime = collections.defaultdict(int)  # work_id -> count
+        count_user = collections.defaultdict(int)  # user_id -> count
+
+        def rate(rating: str) -> float:
+            if rating == "bad":
+                return -1
+            if rating == "good":
+                return 1
+            if rating == "great":
+                return 4
+            return 0.5
+
+        if window_days is None and half_life_days is not None:
+            window_days = half_life_days * DECAY_HORIZON
+        if window_days is not None:
+            logger.info("Training window: %s days", window_days)
+
+        ages = []
+        num_fetch_time = 0  # rows without created_at (aged by fetch time)
+        for _id, user_id, work_id, rating, _dt, created_at, age in dataset.iter_with_age(
+            window_days
+        ):
+            count_anime[work_id] += 1
+            count_user[user_id] += 1
+            ages.append(age)
+            if created_at is None:
+                num_fetch_time += 1
+            if rating is None:
+                continue
+            weight = 1.0
+            if half_life_days is not None:
+                weight = 0.5 ** (max(age, 0.0) / half_life_days)
+            rows.append((work_id, user_id, rate(rating) * weight))
+
+        if window_days is not None and len(ages) > 0:
+            if num_fetch_time > 0:
+                logger.warning(
+                    "%s of %s rows of %s have no created_at and are aged by fetch time (dt); "
+                    "re-fetch them to fill it",
+                    num_fetch_time,
+                    len(ages),
+                    dataset.table,
+                )
+            if max(ages) - min(ages) < 1.0:
+                logger.warning(
+                    "All rows of %s are within a day; the window and decay do nothing",
+                    dataset.table,
+                )
+
+        mat = Matrix()
+
+        for work_id, user_id, ratevalue in rows:
+            if count_anime[work_id] < limit_anime:
+                continue
+            if count_user[user_id] < limit_user:
+                continue
+            mat.insert(work_id, user_id, ratevalue)
+
+        mat.stat()
+        mat.decomposition(factors=200, workers=als_workers)
+
+        self.mat = mat
+        self.titles = titles
+        self.images = images
+        self.test()
+        if compact:
+            mat.compact(dtype)
+
+    def isknown(self, work_id: int) -> bool:
+        """Known Anime?"""
+        return work_id in self.mat.row_id
+
+    def title(self, work_id: int) -> Optional[str]:
+        """Anime Title"""
+        return self.titles.get(work_id, None)
+
+    def image(self, work_id: int) -> str:
+        """Anime Image Url"""
+        return self.images.get(work_id, None)
+
+    def sample_animes(self, n: int) -> List[int]:
+        """Returns List of random work_id"""
+        return [int(self.mat.rows[i]) for i in random.sample(range(len(self.mat.rows)), n)]
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes of each structure (titles and images are shared, so not here)"""
+        return self.mat.memory_usage()
+
+    def similar_items(self, work_id: int, n: int) -> List[Tuple[int, float]]:
+        """Similar animes
+
+        Returns
+        -------
+        List of (work_id: int, score: float)
+        """
+        if not self.isknown(work_id):
+            return []
+        return [
+            (other, score)
+            for other, score in self.mat.similar_items(work_id, n + 1)
+            if other != work_id
+        ][:n]
+
+    def __call__(self, likes: List[int], n: int) -> List[Tuple[int, float]]:
+        """Recommend"""
+        if not any(self.isknown(work_id) for work_id in likes):
+            return []
+        return self.mat.recommend(likes, n)
+
+    def test(self):
+        """Self Testing"""
+        random.seed(42)
+        sample_user_indices = random.sample(list(range(len(self.mat.cols))), 200)
+        # collect likes
+        likes = collections.defaultdict(list)
+        for (work_id, user_idx), rating in self.mat.data.items():
+            if user_idx not in sample_user_indices:
+                continue
+            if rating < 0:
+                continue
+            work_id = self.mat.rows[work_id]
+            likes[user_idx].append(work_id)
+        # testing
+        acc1 = 0
+        acc5 = 0
+        acc10 = 0
+        acc20 = 0
+        num = 0
+        for _ in range(5):
+            for user_idx in sample_user_indices:
+                if len(likes[user_idx]) < 3:
+                    continue
+                ans = random.choice(likes[user_idx])  # pseudo answer
+                likes[user_idx].remove(ans)  # pseudo input
+                pred = self.mat.recommend(likes[user_idx], 20)
+                num += 1
+                if ans in [pair[0] for pair in pred[:1]]:
+                    acc1 += 1
+                if ans in [pair[0] for pair in pred[:5]]:
+                    acc5 += 1
+                if ans in [pair[0] for pair in pred[:10]]:
+                    acc10 += 1
+                if ans in [pair[0] for pair in pred[:20]]:
+                    acc20 += 1
+        logger.info(f"Acc@1 = { acc1 / num }")
+        logger.info(f"Acc@5 = { acc5 / num }")
+        logger.info(f"Acc@10 = { acc10 / num }")
+        logger.info(f"Acc@20 = { acc20 / num }")
+
+
+def env_float(name: str) -> Optional[float]:
+    """Optional float from an environment variable"""
+    value = os.environ.get(name)
+    if not value:
+        return None
+    return float(value)
+
+
+def env_flag(name: str) -> bool:
+    """Boolean from an environment variable (unset, "" and "0" are False)"""
+    return os.environ.get(name, "") not in ("", "0")
+
+
+# Child recommenders: name -> (dataset, limits)
+CHILDREN = {
+    "reviews": (ReviewDB, dict(limit_anime=5, limit_user=5)),
+    "records": (RecordDB, dict(limit_anime=5, limit_user=3)),
+}
+
+
+def child_options() -> Dict[str, object]:
+    """Options of child recommenders, from environment variables"""
+    return dict(
+        window_days=env_float("ISLAND_WINDOW_DAYS"),
+        half_life_days=env_float("ISLAND_HALF_LIFE_DAYS"),
+        compact=env_flag("ISLAND_COMPACT"),
+        dtype=os.environ.get("ISLAND_FACTORS_DTYPE", "float32"),
+        als_workers=int(os.environ.get("ISLAND_ALS_WORKERS", "0")),
+    )
+
+
+def build_child(
+    name: str,
+    titles: Optional[Dict[int, str]] = None,
+    images: Optional[Dict[int, str]] = None,
+) -> Recommendation:
+    """Build a child recommender, with options from environment variables"""
+    dataset, limits = CHILDREN[name]
+    return Recommendation(dataset(), **limits, **child_options(), titles=titles, images=images)
+
+
+def signature() -> str:
+    """What the children are built from: datasets, limits, options and the seed
+
+    Take it before building; recommendations precomputed under another
+    signature are not of the served models.
+    """
+    content = {
+        "datasets": {name: dataset().fingerprint() for name, (dataset, _) in CHILDREN.items()},
+        "limits": {name: limits for name, (_, limits) in CHILDREN.items()},
+        "options": child_options(),
+        "seed": ALS_SEED,
+    }
+    return json.dumps(content, sort_keys=True)
+
+
+class MixRecommendation:
+    """Wrapper of Multiple Recommendations"""
+
+    def __init__(self, children: Dict[str, Recommendation]):
+        """Init with built child recommenders (name -> child)"""
+        self.names = list(children)
+        self.children = list(children.values())
+
+    def prune_works(self) -> Tuple[Dict[int, str], Dict[int, str]]:
+        """Keep titles and images only of works known to some child (for compact mode)
+
+        Returns the new maps, shared by the children.
+        """
+        known = {int(work_id) for child in self.children for work_id in child.mat.rows}
+        titles = {w: t for child in self.children for w, t in child.titles.items() if w in known}
+        images = {w: i for child in self.children for w, i in child.images.items() if w in known}
+        for child in self.children:
+            child.titles = titles
+            child.images = images
+        return titles, images
+
+    def sample_animes(self, n: int) -> List[int]:
+        """Returns List of work_id"""
+        i = random.randrange(len(self.children))
+        return self.children[i].sample_animes(n)
+
+    def title(self, work_id: int) -> Optional[str]:
+        """anime title"""
+        for child in self.children:
+            t = child.title(work_id)
+            if t:
+                return t
+
+    def image(self, work_id: int) -> Optional[str]:
+        """image url"""
+        for child in self.children:
+            t = child.image(work_id)
+            if t:
+                return t
+
+    def __call__(self, likes: List[int], n: int) -> List[Tuple[int, float]]:
+        """Mixture of recommend of children"""
+        items = []
+        for name, child in zip(self.names, self.children):
+            with phase(f"als.{name}"):
+                items += child(likes, n)
+        items.sort(key=lambda item: item[1], reverse=True)
+        used = set()
+        ret = []
+        for work_id, score in items:
+            if work_id in used:
+                continue
+            used.add(work_id)
+            ret.append((work_id, score))
+        return ret[:n]
+
+    def isknown(self, work_id: int) -> bool:
+        """is-known by any children"""
+        for child in self.children:
+            if child.isknown(work_id):
+                return True
+        return False
+
+    def similar_items(self, work_id: int, n: int) -> List[Tuple[int, float]]:
+        """Mixture of similar_items of children"""
+        items = []
+        for name, child in zip(self.names, self.children):
+            with phase(f"als.{name}"):
+                items += child.similar_items(work_id, n)
+        items.sort(key=lambda item: item[1], reverse=True)
+        used = set()
+        ret = []
+        for work_id, score in items:
+            if work_id in used:
+                continue
+            used.add(work_id)
+            ret.append((work_id, score))
+        return ret[:n]
@@ -0,0 +1,138 @@
+import logging
+import os
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy
+from scipy.sparse import coo_matrix, csr_matrix
+
+from island.database import StaffDB
+
+logger = logging.getLogger("uvicorn.main")
+
+
+def tokenize(names: str) -> List[str]:
+    ls = names.split("、")
+    ls = [name for name in ls if len(name) < 10]
+    return ls
+
+
+def tokenize_rows(rows: List[Tuple[int, str, int]]) -> List[Tuple[int, str]]:
+    """StaffDB の行 (id, names, work_id) の列を (work_id, name) の列にする"""
+    return [(work_id, name) for _id, names, work_id in rows for name in tokenize(names)]
+
+
+class StaffGraph:
+    """作品-スタッフ名 の二部グラフ
+
+    作品 ID もスタッフ名も整数 ID に intern して, エッジは int32 の配列で持つ.
+    行の追加はインクリメンタルにできて, ファイルに保存しておける.
+
+    fetch.py は id の降順に取ってくるので, 中断して --from-page で再開すると
+    last_id より小さい id の行が後から入る. 取り込んだ行数が DB の行数と
+    合わなければ (DB の差し替えも含めて) 作り直す.
+    """
+
+    def __init__(self):
+        self.works: List[int] = []  # index -> work_id
+        self.work_index: Dict[int, int] = {}  # work_id -> index
+        self.names: List[str] = []  # index -> name
+        self.name_index: Dict[str, int] = {}  # name -> index
+        self.edge_work = array("i")
+        self.edge_name = array("i")
+        self.last_id = 0  # 取り込み済みの StaffDB.id の最大値
+        self.num_rows = 0  # 取り込み済みの StaffDB の行数
+
+    def intern_work(self, work_id: int) -> int:
+        i = self.work_index.get(work_id)
+        if i is None:
+            i = len(self.works)
+            self.works.append(work_id)
+            self.work_index[work_id] = i
+        return i
+
+    def intern_name(self, name: str) -> int:
+        j = self.name_index.get(name)
+        if j is None:
+            j = len(self.names)
+            self.names.append(name)
+            self.name_index[name] = j
+        return j
+
+    def add(self, rows: List[Tuple[int, str, int]]) -> int:
+        """行の追加
+
+        Parameters
+        ----------
+        rows
+            StaffDB の行 (id, names, work_id) の列
+
+        Returns
+        -------
+        追加したエッジ数
+        """
+        if len(rows) == 0:
+            return 0
+        relations = tokenize_rows(rows)
+        for work_id, name in relations:
+            self.edge_work.append(self.intern_work(work_id))
+            self.edge_name.append(self.intern_name(name))
+        self.last_id = max(self.last_id, max(_id for _id, _, _ in rows))
+        self.num_rows += len(rows)
+        return len(relations)
+
+    def update(self, db: StaffDB) -> int:
+        """DB に新しく入った行だけを追加する
+
+        id が last_id より大きい行を足しても DB の行数と合わなければ全部作り直す
+        """
+        num_rows = len(db)
+        num = 0
+        if self.num_rows <= num_rows:
+            num = self.add(db.since(self.last_id))
+        if self.num_rows != num_rows:
+            logger.warning(
+                "Staff graph has %s rows but StaffDB has %s; rebuilding", self.num_rows, num_rows
+            )
+            self.__init__()
+            num = self.add(db.since(0))
+        return num
+
+    def incidence(self) -> csr_matrix:
+        """作品 x スタッフ名 の接続行列 (0/1)"""
+        rows = numpy.frombuffer(self.edge_work, dtype=numpy.int32)
+        cols = numpy.frombuffer(self.edge_name, dtype=numpy.int32)
+        data = numpy.ones(len(rows), dtype=numpy.float32)
+        mat = coo_matrix((data, (rows, cols)), shape=(len(self.works), len(self.names))).tocsr()
+        mat.data[:] = 1.0  # 重複エッジは 1 本として扱う
+        return mat
+
+    def save(self, path: str):
+        """保存 (書き込み途中で壊れないように置き換える)"""
+        tmp = path + ".tmp.npz"
+        numpy.savez(
+            tmp,
+            works=numpy.array(self.works, dtype=numpy.int64),
+            names=numpy.array(self.names, dtype=str),
+            edge_work=numpy.frombuffer(self.edge_work, dtype=numpy.int32),
+            edge_name=numpy.frombuffer(self.edge_name, dtype=numpy.int32),
+            last_id=numpy.array(self.last_id, dtype=numpy.int64),
+            num_rows=numpy.array(self.num_rows, dtype=numpy.int64),
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "StaffGraph":
+        """保存したものの読み込み"""
+        graph = cls()
+        with numpy.load(path, allow_pickle=False) as f:
+            graph.works = [int(w) for w in f["works"]]
+            graph.names = [str(name) for name in f["names"]]
+            graph.edge_work = array("i", f["edge_work"].astype(numpy.int32).tobytes())
+            graph.edge_name = array("i", f["edge_name"].astype(numpy.int32).tobytes())
+            graph.last_id = int(f["last_id"])
+            # 行数の無い古いファイルは update で作り直される
+            graph.num_rows = int(f["num_rows"]) if "num_rows" in f.files else 0
+        graph.work_index = {w: i for i, w in enumerate(graph.works)}
+        graph.name_index = {name: j for j, name in enumerate(graph.names)}
+        return graph
@@ -1,27 +1,86 @@
-from typing import List, Tuple
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
 
+from island import memory
 from island.database import StaffDB
+from island.staff.graph import StaffGraph
 from island.staff.pagerank import PageRank
 
+logger = logging.getLogger("uvicorn.main")
 
-def tokenize(names: str) -> List[str]:
-    ls = names.split("、")
-    ls = [name for name in ls if len(name) < 10]
-    return ls
+GRAPH_PATH = "dataset/staffs.graph.npz"
 
 
 class StaffModel:
-    def __init__(self):
+    def __init__(self, path: str = GRAPH_PATH, compact: bool = False):
         """
-        データセットの読み込み, PageRank モデルの構築
+        スタッフグラフの読み込み (保存済みなら差分だけ追加), PageRank モデルの構築
+
+        Parameters
+        ----------
+        path
+            スタッフグラフの保存先
+        compact
+            保存したあとスタッフグラフを捨てて PageRank だけ持つ (update できなくなる)
+        """
+        self.path = path
+        self.graph: Optional[StaffGraph] = StaffGraph()
+        if os.path.exists(path):
+            try:
+                self.graph = StaffGraph.load(path)
+            except Exception:
+                logger.exception("Failed to load %s; rebuilding", path)
+        self.update()
+        if compact:
+            self.graph = None
+
+    def update(self) -> int:
+        """StaffDB に新しく入った行をグラフに追加して PageRank を作り直す
+
+        Returns
+        -------
+        追加したエッジ数
         """
-        relations = set()
-        for _id, names, work_id, _dt in StaffDB():
-            for name in tokenize(names):
-                relations.add((work_id, name))
-        self.model = PageRank(relations)
+        if self.graph is None:
+            raise RuntimeError("Compact StaffModel cannot be updated")
+        watermark = (self.graph.last_id, self.graph.num_rows)
+        num = self.graph.update(StaffDB())
+        logger.info(
+            "Staff graph: %s edges added (last_id=%s, rows=%s)",
+            num,
+            self.graph.last_id,
+            self.graph.num_rows,
+        )
+        if watermark != (self.graph.last_id, self.graph.num_rows) or not os.path.exists(self.path):
+            self.graph.save(self.path)
+        self.model = PageRank(self.graph.incidence(), self.graph.works)
+        return num
+
+    def memory_usage(self) -> Dict[str, int]:
+        """各構造のバイト数"""
+        structures = {
+            "pagerank.graph": self.model.graph,
+            "pagerank.works": self.model.works,
+            "pagerank.index": self.model.index,
+        }
+        if self.graph is not None:
+            structures.update(
+                {
+                    "graph.works": self.graph.works,
+                    "graph.work_index": self.graph.work_index,
+                    "graph.names": self.graph.names,
+                    "graph.name_index": self.graph.name_index,
+                    "graph.edges": [self.graph.edge_work, self.graph.edge_name],
+                }
+            )
+        return memory.report(structures)
+
+    def isknown(self, work_id: int) -> bool:
+        """スタッフグラフにある作品か"""
+        return work_id in self.model.index
 
-    def similar_items(self, work_id: str, num: int) -> List[Tuple[str, float]]:
+    def similar_items(self, work_id: int, num: int) -> List[Tuple[int, float]]:
         """ここで自分自身を除く"""
         res = self.model.ranks(work_id, num + 3, depth=3)
         return [(u, p) for u, p in res if u != work_id][:num]
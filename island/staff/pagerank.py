@@ -1,76 +1,165 @@
-import random
 from collections import defaultdict
-from typing import List, Set, Tuple
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+from scipy.sparse import csr_matrix, diags
+
+from island.memory import IntIndex
+
+
+def weigh(incidence: csr_matrix, weighting: str, k1: float = 1.2, b: float = 0.75) -> csr_matrix:
+    """接続行列のエッジに重みをつける
+
+    Parameters
+    ----------
+    incidence
+        作品 x スタッフ名 の接続行列 (0/1)
+    weighting
+        "none", "tfidf" or "bm25"
+    k1, b
+        BM25 のパラメータ
+    """
+    if weighting == "none":
+        return incidence
+    num_works = incidence.shape[0]
+    df = numpy.asarray(incidence.sum(axis=0)).ravel()
+    length = numpy.asarray(incidence.sum(axis=1)).ravel()  # 作品ごとのスタッフ名の数
+    if weighting == "tfidf":
+        idf = numpy.log(num_works / numpy.maximum(df, 1.0))
+        norm = 1.0 / numpy.sqrt(numpy.maximum(length, 1.0))
+    elif weighting == "bm25":
+        idf = numpy.log(1.0 + (num_works - df + 0.5) / (df + 0.5))
+        avglen = max(length.mean(), 1.0) if len(length) > 0 else 1.0
+        norm = (k1 + 1.0) / (1.0 + k1 * (1.0 - b + b * length / avglen))
+    else:
+        raise ValueError(f"Unknown weighting: {weighting}")
+    return (diags(norm.astype(numpy.float32)) @ incidence @ diags(idf.astype(numpy.float32))).tocsr()
+
+
+def prune(graph: csr_matrix, num: Optional[int]) -> csr_matrix:
+    """各行を重みの降順に並べ, 上位 num 個だけ残す"""
+    indptr = [0]
+    indices = []
+    data = []
+    for i in range(graph.shape[0]):
+        start, end = graph.indptr[i], graph.indptr[i + 1]
+        cols = graph.indices[start:end]
+        vals = graph.data[start:end]
+        if num is not None and len(cols) > num:
+            top = numpy.argpartition(-vals, num)[:num]
+            cols = cols[top]
+            vals = vals[top]
+        order = numpy.argsort(-vals, kind="stable")
+        indices.append(cols[order])
+        data.append(vals[order])
+        indptr.append(indptr[-1] + len(order))
+    if len(indices) == 0:
+        return graph
+    return csr_matrix(
+        (numpy.concatenate(data), numpy.concatenate(indices), numpy.array(indptr)),
+        shape=graph.shape,
+    )
 
 
 class PageRank:
     """アニメ-スタッフ 二部グラフ用の PageRank"""
 
-    def __init__(self, relations: Set[Tuple[str, str]], num_staff_freq: int = 3):
+    def __init__(
+        self,
+        incidence: csr_matrix,
+        works: List[int],
+        num_staff_freq: int = 3,
+        max_staff_freq: Optional[int] = 300,
+        weighting: str = "bm25",
+        max_neighbours: Optional[int] = 50,
+    ):
         """グラフの構築
 
         Parameters
         ----------
-        relations
-            エッジ集合
+        incidence
+            作品 x スタッフ名 の接続行列
+        works
+            行番号 -> work_id
         num_staff_freq
             登場回数がコレ未満のスタッフ名は使わない
+        max_staff_freq
+            登場回数がコレより多いスタッフ名 (スタジオなどのハブ) は使わない
+        weighting
+            エッジの重み付け ("none", "tfidf" or "bm25")
+        max_neighbours
+            作品ごとに残す隣接作品の数
         """
-        staff_freq = defaultdict(int)
-        for (_, name) in relations:
-            staff_freq[name] += 1
-
-        work2name = defaultdict(list)  # work_id -> name
-        name2work = defaultdict(list)  # name -> work_id
-        for (work, name) in relations:
-            if staff_freq[name] < num_staff_freq:
-                continue
-            work2name[work].append(name)
-            name2work[name].append(work)
+        staff_freq = numpy.asarray(incidence.sum(axis=0)).ravel()
+        used = staff_freq >= num_staff_freq
+        if max_staff_freq is not None:
+            used &= staff_freq <= max_staff_freq
+        incidence = (incidence @ diags(used.astype(numpy.float32))).tocsr()
+        incidence.eliminate_zeros()
+        incidence = weigh(incidence, weighting)
 
         # name を経由した work -> work なグラフ
-        # graph = name2work . work2name
-        graph = defaultdict(list)
-        for (u, names) in work2name.items():
-            for name in names:
-                for v in name2work[name]:
-                    graph[u].append(v)
-
-        del work2name
-        del name2work
+        # graph = name2work . work2name を疎行列の積で作って,
+        # 各行の上位 max_neighbours 個だけ残して確率に正規化する
+        graph = prune((incidence @ incidence.T).tocsr(), max_neighbours)
+        degree = numpy.asarray(graph.sum(axis=1)).ravel()
+        degree[degree == 0] = 1.0
+        graph = (diags(1.0 / degree) @ graph).tocsr()
+
         self.graph = graph
+        self.works = numpy.asarray(works, dtype=numpy.int32)
+        self.index = IntIndex(works)
+
+    def neighbours(self, i: int, num: int) -> List[Tuple[int, float]]:
+        """行番号 i から 1 歩で行ける上位 num 個の (行番号, 確率)
 
-    def ranks(self, cur: str, num: int, depth: int) -> List[Tuple[str, float]]:
+        各行は確率の降順に並べてあるので先頭から取るだけ
+        """
+        start = self.graph.indptr[i]
+        end = min(self.graph.indptr[i + 1], start + num)
+        return list(zip(self.graph.indices[start:end].tolist(), self.graph.data[start:end].tolist()))
+
+    def ranks(self, cur: int, num: int, depth: int) -> List[Tuple[int, float]]:
         """cur から高々 depth だけ辿って到達する頂点とその確率を返す
 
         Parameters
         ----------
         cur
-            現在地点
+            現在地点 (work_id)
         num
             上位いくつ欲しいか
         depth
             残りどれだけ深く潜るか
         """
-        if depth <= 0 or len(self.graph[cur]) == 0:
+        i = self.index.get(cur)
+        if i is None:
             return [(cur, 1.0)]
+        return [(int(self.works[j]), p) for j, p in self._ranks(i, num, depth, {})]
 
-        neigh = defaultdict(float)
-        m = len(self.graph[cur])
-        for u in self.graph[cur]:
-            neigh[u] += 1.0 / m
+    def _ranks(
+        self,
+        i: int,
+        num: int,
+        depth: int,
+        memo: Dict[Tuple[int, int], List[Tuple[int, float]]],
+    ) -> List[Tuple[int, float]]:
+        """行番号での ranks
 
-        neigh: List[Tuple[str, float]] = list(neigh.items())
-        neigh.sort(key=lambda item: item[1], reverse=True)
-        neigh = neigh[:num]
+        同じ (頂点, 深さ) は何度も訪れるので memo に覚えておく
+        """
+        if depth <= 0 or self.graph.indptr[i] == self.graph.indptr[i + 1]:
+            return [(i, 1.0)]
+        if (i, depth) in memo:
+            return memo[(i, depth)]
 
         reached = defaultdict(float)
-        for u, p in neigh:
+        for u, p in self.neighbours(i, num):
             reached[u] += p
-            for v, q in self.ranks(u, num, depth - 1):
+            for v, q in self._ranks(u, num, depth - 1, memo):
                 reached[v] += p * q
         reached = list(reached.items())
         reached.sort(key=lambda item: item[1], reverse=True)
         reached = reached[:num]
 
+        memo[(i, depth)] = reached
         return reached
@@ -0,0 +1,163 @@
+import gzip
+import hashlib
+import json
+from typing import Dict, Optional
+
+from fastapi import Request, Response
+
+from island.profiling import phase
+
+# Both are dependencies; the fallbacks are for bare environments
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+def dumps(content) -> bytes:
+    """Serialize as JSON (with orjson if available)"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def accepted_encoding(request: Request) -> Optional[str]:
+    """Preferred content-encoding for the client
+
+    Returns
+    -------
+    "br", "gzip" or None
+    """
+    accept = request.headers.get("accept-encoding", "")
+    encodings = {token.split(";")[0].strip() for token in accept.split(",")}
+    if brotli is not None and "br" in encodings:
+        return "br"
+    if "gzip" in encodings:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    """Compress body with the encoding"""
+    if encoding == "br":
+        return brotli.compress(body)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def opaque(etag: str) -> str:
+    """ETag without the weak indicator"""
+    return etag[2:] if etag.startswith("W/") else etag
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Is If-None-Match satisfied? (weak comparison, as RFC 7232 specifies for it)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = {opaque(tag.strip()) for tag in if_none_match.split(",")}
+    return "*" in tags or opaque(etag) in tags
+
+
+def variant_etag(etag: str, encoding: Optional[str]) -> str:
+    """Strong ETag of an encoded variant ("<hash>" -> "<hash>-br")"""
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def not_modified(etag: str, cache_control: str) -> Response:
+    """304"""
+    return Response(
+        status_code=304,
+        headers={"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"},
+    )
+
+
+class StaticPage:
+    """A template loaded into memory once, with precompressed variants"""
+
+    def __init__(self, path: str, cache_control: str = "public, max-age=3600"):
+        """Load and compress
+
+        Parameters
+        ----------
+        path
+            path of the html file
+        cache_control
+            Cache-Control header value
+        """
+        with open(path, "rb") as f:
+            body = f.read()
+        self.cache_control = cache_control
+        etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+        self.variants: Dict[Optional[str], bytes] = {None: body}
+        self.variants["gzip"] = compress(body, "gzip")
+        if brotli is not None:
+            self.variants["br"] = compress(body, "br")
+        self.etags = {encoding: variant_etag(etag, encoding) for encoding in self.variants}
+
+    def response(self, request: Request) -> Response:
+        """Respond with the best variant, or 304"""
+        encoding = accepted_encoding(request)
+        etag = self.etags[encoding]
+        if etag_matches(request, etag):
+            return not_modified(etag, self.cache_control)
+        headers = {
+            "ETag": etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return Response(
+            self.variants[encoding],
+            media_type="text/html",
+            headers=headers,
+        )
+
+
+def version_etag(version: str, request: Request) -> str:
+    """ETag for an API response, derived from the model version and the query
+
+    The response is a function of (models, query), so this can be checked
+    before computing the response at all. It is weak: whether the body is
+    compressed is decided only after computing it.
+    """
+    key = f"{request.url.path}?{request.url.query}".encode()
+    return f'W/"{version}-{hashlib.sha1(key).hexdigest()[:12]}"'
+
+
+def json_response(
+    request: Request,
+    content,
+    etag: Optional[str] = None,
+    cache_control: str = "no-store",
+    status_code: int = 200,
+) -> Response:
+    """JSON response, compressed when accepted and worthwhile"""
+    with phase("serialize"):
+        body = dumps(content)
+        headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if etag is not None:
+            headers["ETag"] = etag
+        encoding = accepted_encoding(request) if len(body) >= MIN_COMPRESS_SIZE else None
+        if encoding is not None:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+    return Response(
+        body,
+        status_code=status_code,
+        media_type="application/json",
+        headers=headers,
+    )
@@ -0,0 +1,110 @@
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from typing import List, Optional, Tuple
+
+import click
+from rich.logging import RichHandler
+
+from island.database import PrecomputedDB, RecordDB, ReviewDB
+from island.recommendation import (
+    CHILDREN,
+    MixRecommendation,
+    build_child,
+    load_works,
+    signature,
+)
+
+FORMAT = "%(message)s"
+logging.basicConfig(level="INFO", format=FORMAT, datefmt="[%X]", handlers=[RichHandler()])
+logger = logging.getLogger("precompute.py")
+
+# Same as /anime/api/recommend
+NUM_ITEMS = 20
+
+# Shared with forked workers
+recommender: Optional[MixRecommendation] = None
+
+
+def mine_like_sets(
+    recommender: MixRecommendation, num_popular: int, num_pairs: int
+) -> List[Tuple[int, ...]]:
+    """Like-sets to precompute
+
+    All single works known to the recommender, and the most frequent pairs
+    co-liked by a user among the num_popular most liked works.
+    """
+    liked = collections.defaultdict(set)  # user_id -> work_ids
+    for dataset in [ReviewDB(), RecordDB()]:
+        for _id, user_id, work_id, rating, *_ in dataset:
+            if rating in ("good", "great") and recommender.isknown(work_id):
+                liked[user_id].add(work_id)
+
+    popularity = collections.Counter(w for works in liked.values() for w in works)
+    popular = {w for w, _ in popularity.most_common(num_popular)}
+    pairs = collections.Counter()
+    for works in liked.values():
+        pairs.update(itertools.combinations(sorted(works & popular), 2))
+
+    singles = sorted({int(w) for child in recommender.children for w in child.mat.rows})
+    like_sets = [(w,) for w in singles]
+    like_sets += [pair for pair, _ in pairs.most_common(num_pairs)]
+    logger.info("%s singles, %s pairs", len(singles), len(like_sets) - len(singles))
+    return like_sets
+
+
+def recommend_chunk(
+    like_sets: List[Tuple[int, ...]]
+) -> List[Tuple[List[int], List[Tuple[int, float]]]]:
+    """Run in a worker"""
+    return [(list(likes), recommender(list(likes), NUM_ITEMS)) for likes in like_sets]
+
+
+@click.command()
+@click.option("--output", default="dataset/precomputed.db")
+@click.option("--popular", default=500, help="Pairs are mined among this many popular works")
+@click.option("--pairs", default=20000, help="Num of pairs to precompute")
+@click.option("--workers", default=os.cpu_count())
+@click.option("--chunk-size", default=200)
+def main(output: str, popular: int, pairs: int, workers: int, chunk_size: int):
+    """Precompute recommendations for frequent like-sets"""
+    global recommender
+    start = time.time()
+    sig = signature()  # before building, as the server does
+    titles, images = load_works()
+    recommender = MixRecommendation(
+        {name: build_child(name, titles, images) for name in CHILDREN}
+    )
+    logger.info("Models built in %.1f sec", time.time() - start)
+
+    like_sets = mine_like_sets(recommender, popular, pairs)
+    chunks = [like_sets[i : i + chunk_size] for i in range(0, len(like_sets), chunk_size)]
+
+    # Write into a temporary file, and replace at once
+    tmp = output + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = PrecomputedDB(tmp)
+
+    start = time.time()
+    done = 0
+    # fork to share the built models with workers
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        for items in pool.imap_unordered(recommend_chunk, chunks):
+            db.insert_many(items)
+            done += len(items)
+            elapsed = time.time() - start
+            logger.info("%s / %s (%.1f like-sets/sec)", done, len(like_sets), done / elapsed)
+    # The server uses this file only with the same signature; version goes into ETags
+    db.set_meta("signature", sig)
+    db.set_meta("version", format(int(time.time()), "x"))
+    db.con.close()
+    os.replace(tmp, output)
+    logger.info("Wrote %s like-sets to %s in %.1f sec", done, output, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()